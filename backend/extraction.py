@@ -0,0 +1,131 @@
+"""
+书籍文本提取（PDF / EPUB / TXT）
+
+这些函数在提取进程池的工作进程中运行。进程池用 spawn 启动，工作进程只需导入本模块，
+不会重新执行 main.py 的模块级初始化（加载分词表、创建 FastAPI 应用、读取前端页面等）。
+"""
+import os
+import tempfile
+import fitz  # PyMuPDF
+import ebooklib
+from ebooklib import epub
+from bs4 import BeautifulSoup
+from lxml import html as lxml_html
+
+# PDF 解析并行化：按页码区间切分，每个区间交给独立进程重新打开文件提取
+PDF_PAGES_PER_TASK = 64
+# 仅需纯文本喂给 LLM：不保留连字(ligature)与图片，只保留空白，减少 MuPDF 内部开销
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+# MuPDF 的资源缓存默认不设上限，且文档关闭后仍会保留；每提取这么多页清空一次，图片多的 PDF 也不会把内存撑到 GB 级
+PDF_STORE_SHRINK_PAGES = 50
+
+def _page_text(page):
+    """以最轻量的参数提取单页纯文本"""
+    return page.get_text("text", flags=PDF_TEXT_FLAGS, sort=False)
+
+def _open_pdf(source):
+    """打开 PDF：source 可以是文件路径，也可以是内存中的 bytes / bytearray"""
+    if isinstance(source, str):
+        # 显式指定类型，不按扩展名和文件头猜测格式
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+def extract_pdf_range(source, start, end):
+    """在工作进程中提取 [start, end) 页的文本"""
+    parts = []
+    with _open_pdf(source) as doc:
+        for i in range(start, end):
+            parts.append(_page_text(doc[i]))
+            if (i - start + 1) % PDF_STORE_SHRINK_PAGES == 0:
+                fitz.TOOLS.store_shrink(100)
+    # 工作进程长期复用，每个任务结束时清空缓存
+    fitz.TOOLS.store_shrink(100)
+    return "".join(parts)
+
+def pdf_page_count(source):
+    """读取 PDF 页数（只解析文档结构，不提取文字）"""
+    with _open_pdf(source) as doc:
+        return doc.page_count
+
+def _extract_pdf(source, max_chars=None):
+    """逐页提取 PDF 文本，返回按页序排列的文本片段列表；给定 max_chars 时累计字数达到后提前结束"""
+    parts = []
+    total_chars = 0
+    with _open_pdf(source) as doc:
+        # 页面按需加载，提前 break 的页不会被解析
+        for page_no, page in enumerate(doc, 1):
+            text = _page_text(page)
+            parts.append(text)
+            total_chars += len(text)
+            if max_chars and total_chars >= max_chars:
+                break
+            if page_no % PDF_STORE_SHRINK_PAGES == 0:
+                fitz.TOOLS.store_shrink(100)
+    fitz.TOOLS.store_shrink(100)
+    return parts
+
+def _html_text(content):
+    """提取 HTML 章节的纯文本"""
+    try:
+        # lxml 使用 C 实现的 HTML 解析器，比 html.parser 快一个数量级
+        return lxml_html.fromstring(content).text_content()
+    except Exception:
+        # 空章节或畸形 HTML 时回退到 BeautifulSoup
+        return BeautifulSoup(content, 'html.parser').get_text()
+
+def _extract_epub(file_path, max_chars=None):
+    """提取 EPUB 章节文本；给定 max_chars 时累计字数达到后不再解析后续章节"""
+    parts = []
+    total_chars = 0
+    book = epub.read_epub(file_path)
+    # 直接遍历生成器，不再 list(...) 物化全部条目
+    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        # 单个章节损坏时跳过，不影响整本书的提取
+        try:
+            text = _html_text(item.get_content())
+        except Exception as e:
+            print(f"[LOG] 跳过无法解析的章节 {item.get_name()}: {e}")
+            continue
+        parts.append(text)
+        total_chars += len(text)
+        if max_chars and total_chars >= max_chars:
+            break
+    return parts
+
+def extract_text_from_any(file_path, max_chars=None):
+    """万能格式解析 - 支持全书读取（max_chars 为空或 0 时不限制字数）"""
+    ext = os.path.splitext(file_path)[1].lower()
+    # 用列表收集片段，最后一次性 join，避免 text += ... 在大书上退化为 O(n²)
+    parts = []
+    try:
+        if ext == ".pdf":
+            parts = _extract_pdf(file_path, max_chars)
+        elif ext == ".epub":
+            parts = _extract_epub(file_path, max_chars)
+        elif ext in [".txt", ".md"]:
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                parts.append(f.read(max_chars or -1))
+    except Exception as e:
+        print(f"解析出错: {e}")
+    # 按页 / 章节提取会越过上限，统一截断到 max_chars，保证同一缓存键下各条路径的结果一致
+    return "".join(parts)[:max_chars or None]
+
+def extract_text_from_bytes(data, ext, max_chars=None, tmp_dir=None):
+    """直接从内存中的上传内容解析，省去写临时文件再读回的磁盘往返（EPUB 的临时文件建在 tmp_dir 下）"""
+    parts = []
+    try:
+        if ext == ".pdf":
+            parts = _extract_pdf(data, max_chars)
+        elif ext == ".epub":
+            # ebooklib 只接受文件路径，EPUB 仍需落一次临时文件（关闭即删除）
+            with tempfile.NamedTemporaryFile(suffix=".epub", dir=tmp_dir) as tmp:
+                tmp.write(data)
+                tmp.flush()
+                parts = _extract_epub(tmp.name, max_chars)
+        elif ext in [".txt", ".md"]:
+            text = data.decode("utf-8", errors="ignore")
+            parts.append(text[:max_chars] if max_chars else text)
+    except Exception as e:
+        print(f"解析出错: {e}")
+    # 按页 / 章节提取会越过上限，统一截断到 max_chars，保证同一缓存键下各条路径的结果一致
+    return "".join(parts)[:max_chars or None]
@@ -1,19 +1,34 @@
 import os
+import re
+import math
+import codecs
+import stat
 import datetime
+import time
 import urllib.parse
-import fitz  # PyMuPDF
 import hashlib
+import uuid
 import asyncio
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from contextlib import asynccontextmanager
+import tempfile
+import shutil
+import aiofiles
+import aiofiles.os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, Response
 import json
+import orjson
 from dotenv import load_dotenv
-from ebooklib import epub
-from bs4 import BeautifulSoup
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError
 import httpx
+import tiktoken
 from httpx import ConnectError, TimeoutException, RequestError, ReadTimeout, ConnectTimeout
+from extraction import PDF_PAGES_PER_TASK, extract_pdf_range, pdf_page_count, extract_text_from_any, extract_text_from_bytes
 
 # 1. 配置加载
 load_dotenv()
@@ -22,28 +37,109 @@ OUTPUT_DIR = os.getenv("OUTPUT_DIRECTORY", "/app/output") # 建议 Docker 内部
 
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+# 启动时解析一次绝对路径，下载接口直接复用
+OUTPUT_DIR_ABS = os.path.abspath(OUTPUT_DIR)
 
-# 配置 httpx 异步客户端，设置超时和代理
-# 在本地测试环境下，优先尝试直连 api.deepseek.com 而非强制走系统代理
-# 设置 proxies=None 可以：
-# 1. 绕过系统代理设置，避免代理不稳定导致的连接问题
-# 2. 优先直连 api.deepseek.com，提高连接速度和稳定性
-# 3. 如果确实需要代理，可以通过环境变量 HTTP_PROXY 或 HTTPS_PROXY 设置
-http_client = httpx.AsyncClient(
-    timeout=httpx.Timeout(300.0, connect=30.0),  # 总超时300秒，连接超时30秒（支持全书解构）
-    proxies=None,  # 显式禁用代理，避免不稳定的系统代理，优先直连
-    limits=httpx.Limits(max_keepalive_connections=5, max_connections=10),
-    follow_redirects=True
-)
+# 中间结果缓存目录：按文件内容哈希保存提取文本与脱水稿，与解构模式无关，三种模式共用
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+# 分段脱水结果缓存目录：按片段内容哈希保存单个片段的脱水结果，重跑同一本书或不同书中相同的片段（版权页、目录、附录等）不再重复调用 API
+CHUNK_CACHE_DIR = os.path.join(OUTPUT_DIR, ".chunk_cache")
+os.makedirs(CHUNK_CACHE_DIR, exist_ok=True)
 
-# 初始化 OpenAI 客户端，使用自定义 http_client
-client = OpenAI(
-    api_key=API_KEY,
-    base_url="https://api.deepseek.com/v1",
-    http_client=http_client
-)
+def _env_int(name, default):
+    """读取正整数环境变量；未设置、为空、不是整数或不大于 0 时使用默认值"""
+    try:
+        value = int(os.getenv(name, ""))
+    except ValueError:
+        return default
+    return value if value > 0 else default
+
+# 默认最多提取的字数，超出部分不再解析（/analyze 可通过 max_chars=0 显式开启全书模式）
+MAX_EXTRACT_CHARS = _env_int("MAX_EXTRACT_CHARS", 400000)
+# 每个 uvicorn worker 的文本提取进程数：可用 EXTRACT_WORKERS 直接指定；
+# 默认多个 worker 平分 CPU，但至少 2 个，保证大 PDF 的页区间仍能并行提取（提取是突发负载，短时超额可以接受）
+EXTRACT_WORKERS = _env_int("EXTRACT_WORKERS", max(2, (os.cpu_count() or 1) // _env_int("WEB_CONCURRENCY", 1)))
+# 上传文件流式写盘的分块大小
+UPLOAD_CHUNK_SIZE = 1 << 20
+# 不超过该大小的上传直接在内存中解析，不落盘
+IN_MEMORY_UPLOAD_LIMIT = 8 << 20
+# 分段脱水时同时在途的 DeepSeek 请求上限（避免触发账号限流）
+DEHYDRATE_CONCURRENCY = 8
+# 分段脱水请求遇到 429 / 5xx / 连接错误时的重试次数（SDK 内置指数退避）
+DEHYDRATE_MAX_RETRIES = 4
+# 最终汇总流式输出时合并增量：攒满 SSE_FLUSH_CHARS 个字符或距上次推送超过 SSE_FLUSH_INTERVAL 秒就推送一帧
+# （前端每收到一帧都会重新渲染整篇 Markdown，帧数越少前端越省）
+SSE_FLUSH_INTERVAL = 0.05
+SSE_FLUSH_CHARS = 4096
+# 全文不超过该 token 数时直接一次性汇总，不走分段脱水（DeepSeek 上下文为 64K，留出输出余量）
+ONE_SHOT_TOKENS = 50000
+# 分段脱水的每段 token 预算（DeepSeek 按 token 计费和限长，按字符切分对中英文偏差很大）
+CHUNK_TOKENS = 8000
+
+# 缓存键用的内容哈希：只需要快，不需要抗碰撞攻击；优先用 xxh3_128（比 MD5 快一个数量级），未安装时退化为 blake2b
+try:
+    import xxhash
+    new_content_hash = xxhash.xxh3_128
+except ImportError:
+    def new_content_hash(data=b""):
+        return hashlib.blake2b(data, digest_size=16)
+
+class _CharEncoding:
+    """tiktoken 分词表不可用时的退化实现：每个字符计为一个 token"""
+    def encode_ordinary(self, text):
+        return text
+    def encode_ordinary_batch(self, texts):
+        return texts
+    def decode_bytes(self, tokens):
+        return tokens.encode("utf-8")
+
+# BPE 分词器（Rust 实现），仅用于估算 token 数，与 DeepSeek 实际分词近似
+# 分词表首次使用时需联网下载，离线或网络受限时退化为按字符估算
+try:
+    TOKEN_ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    print(f"[LOG] 加载 tiktoken 分词表失败，改为按字符数估算 token: {e}")
+    TOKEN_ENCODING = _CharEncoding()
+
+def count_tokens(text):
+    """估算文本的 token 数"""
+    return len(TOKEN_ENCODING.encode_ordinary(text))
+
+def new_extract_pool():
+    """创建文本提取进程池
+
+    工作进程按需懒启动，此时事件循环和线程池早已存在，fork 出的子进程可能继承被其他线程持有的锁；
+    用 spawn 启动全新的解释器，不继承父进程状态。
+    """
+    return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@asynccontextmanager
+async def lifespan(app):
+    """应用生命周期：每个 worker 进程启动时创建 HTTP 连接池，关闭时释放"""
+    # 配置 httpx 异步客户端，设置超时和连接池
+    # 默认直连 api.deepseek.com；如果确实需要代理，可以通过环境变量 HTTP_PROXY 或 HTTPS_PROXY 设置
+    # （httpx 0.28 起已移除 proxies 参数，原先的 proxies=None 本就等同于默认行为）
+    app.state.http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(300.0, connect=30.0),  # 总超时300秒，连接超时30秒（支持全书解构）
+        http2=True,  # HTTP/2 多路复用：并发的分段脱水请求共用一条 TCP/TLS 连接
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),  # 容纳分段脱水的并发请求
+        follow_redirects=True
+    )
+
+    # 初始化异步 OpenAI 客户端，使用自定义 http_client（必须与 httpx.AsyncClient 配套）
+    app.state.openai = AsyncOpenAI(
+        api_key=API_KEY,
+        base_url="https://api.deepseek.com/v1",
+        http_client=app.state.http_client
+    )
+    # CPU 密集的文本提取（MuPDF / lxml）放进进程池，避免阻塞事件循环和 GIL 争用
+    app.state.extract_pool = new_extract_pool()
+    yield
+    await app.state.http_client.aclose()
+    app.state.extract_pool.shutdown()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 2. CORS 中间件
 app.add_middleware(
@@ -52,6 +148,25 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 不参与 gzip 的路由：/analyze 是 SSE 流，压缩会缓冲帧、破坏逐帧推送
+# （新版 Starlette 默认跳过 text/event-stream，但依赖未锁版本，按路径排除不受版本影响）
+GZIP_EXCLUDED_PATHS = ("/analyze",)
+
+class SelectiveGZipMiddleware:
+    """对 GZIP_EXCLUDED_PATHS 之外的 HTTP 响应启用 gzip"""
+    def __init__(self, app, minimum_size=1024):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(GZIP_EXCLUDED_PATHS):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+# 下载的 Markdown 报告文本冗余度高，gzip 后通常只有原来的几分之一；对文本报告而言传输字节数比 sendfile 零拷贝更重要，
+# 因此 /download 保留压缩（不接受 gzip 的客户端仍走 FileResponse 的 sendfile 路径）
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024)
 
 # 提示词模板字典（Master Protocol - 终极硬核版本）
 PROMPT_TEMPLATES = {
@@ -325,29 +440,118 @@ Tags: [自动识别书籍类别，如：投资理财、认知科学、商业策
 - 如果书中没有反常识内容，必须质疑书中的核心假设"""
 }
 
-def extract_text_from_any(file_path):
-    """万能格式解析 - 支持全书读取"""
-    ext = os.path.splitext(file_path)[1].lower()
-    text = ""
+# 初步脱水提示词（用于分段解构）
+PRELIMINARY_PROMPT = """你是一位知识提取专家。请对提供的文本片段进行"初步脱水"：
+1. 提取核心观点和关键信息
+2. 保留重要的数据、公式、案例
+3. 去除冗余描述和修饰性语言
+4. 保持逻辑结构清晰
+5. 输出格式为简洁的 Markdown
+
+请开始脱水："""
+
+# 启动时预构建 system 消息对象，每次请求（含 N 路分段脱水）直接复用
+SYSTEM_MESSAGES = {k: {"role": "system", "content": v} for k, v in PROMPT_TEMPLATES.items()}
+PRELIMINARY_MESSAGE = {"role": "system", "content": PRELIMINARY_PROMPT}
+
+# 预先计算各提示词的 token 数，供 token 预算计算使用
+PROMPT_TOKENS = {k: count_tokens(v) for k, v in PROMPT_TEMPLATES.items()}
+PRELIMINARY_PROMPT_TOKENS = count_tokens(PRELIMINARY_PROMPT)
+
+async def _extract_in_pool(pool, source, ext, max_chars=None):
+    """在进程池中解析上传内容，不阻塞事件循环；source 为临时文件路径或内存中的 bytes
+
+    大 PDF 按页区间拆成多个任务分轮并行提取：不限字数时每轮提交与工作进程数相同的区间；
+    有字数上限时按已提取的每页字数估算本轮所需区间数，字数够了就不再提交。其余情况整体作为一个任务交给进程池。
+    返回的文本都截断到 max_chars。
+    """
+    loop = asyncio.get_running_loop()
+    if ext == ".pdf":
+        try:
+            # 损坏的大文件打开时可能要修复 xref，同样放进进程池，不阻塞事件循环
+            page_count = await loop.run_in_executor(pool, pdf_page_count, source)
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            print(f"解析出错: {e}")
+            return ""
+        if page_count > PDF_PAGES_PER_TASK:
+            parts = []
+            total_chars = 0
+            pages_done = 0
+            ranges = [(i, min(i + PDF_PAGES_PER_TASK, page_count)) for i in range(0, page_count, PDF_PAGES_PER_TASK)]
+            next_range = 0
+            try:
+                while next_range < len(ranges):
+                    # 不限字数时每轮占满所有工作进程；有上限时先提取一个区间估算每页字数，
+                    # 之后每轮只提交预计凑够剩余字数所需的区间数，不会在上限之后多解析一整轮
+                    if not max_chars:
+                        wave = EXTRACT_WORKERS
+                    elif pages_done == 0:
+                        wave = 1
+                    else:
+                        chars_per_page = max(total_chars / pages_done, 1)
+                        pages_needed = (max_chars - total_chars) / chars_per_page
+                        wave = min(EXTRACT_WORKERS, max(1, math.ceil(pages_needed / PDF_PAGES_PER_TASK)))
+                    batch = ranges[next_range:next_range + wave]
+                    next_range += wave
+                    texts = await asyncio.gather(*[
+                        loop.run_in_executor(pool, extract_pdf_range, source, start, end)
+                        for start, end in batch
+                    ])
+                    parts.extend(texts)
+                    total_chars += sum(len(t) for t in texts)
+                    pages_done += sum(end - start for start, end in batch)
+                    if max_chars and total_chars >= max_chars:
+                        break
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                print(f"解析出错: {e}")
+            return "".join(parts)[:max_chars or None]
+    if isinstance(source, str):
+        return await loop.run_in_executor(pool, extract_text_from_any, source, max_chars)
+    return await loop.run_in_executor(pool, extract_text_from_bytes, source, ext, max_chars, OUTPUT_DIR)
+
+async def extract_text_async(app, source, ext, max_chars=None):
+    """用 app.state 上的进程池解析上传内容
+
+    工作进程崩溃（如 MuPDF 在畸形 PDF 上段错误）会让整个进程池永久不可用：此时换上新的进程池，
+    后续请求不受影响。崩溃时同一个池上所有在途的请求都会失败，无法区分是哪个文件导致的，
+    因此返回 503 提示重试，而不是断定用户的文件已损坏。
+    """
+    pool = app.state.extract_pool
     try:
-        if ext == ".pdf":
-            with fitz.open(file_path) as doc:
-                # 提取全书内容，不再限制页数
-                for page in doc:
-                    text += page.get_text()
-        elif ext == ".epub":
-            book = epub.read_epub(file_path)
-            items = list(book.get_items_of_type(9))
-            # 提取所有章节，不再限制数量
-            for item in items:
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text += soup.get_text()
-        elif ext in [".txt", ".md"]:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                text = f.read()  # 读取全部内容，不再限制长度
-    except Exception as e:
-        print(f"解析出错: {e}")
-    return text
+        return await _extract_in_pool(pool, source, ext, max_chars)
+    except BrokenProcessPool as e:
+        print(f"[LOG] 文本提取进程异常退出，重建进程池: {e}")
+        # 同一个池上并发的多个请求会同时走到这里，只替换一次
+        if app.state.extract_pool is pool:
+            app.state.extract_pool = new_extract_pool()
+            pool.shutdown(wait=False)
+        raise HTTPException(status_code=503, detail="文本解析进程异常退出，服务已自动恢复，请重新上传", headers={"Retry-After": "1"})
+
+# 文件命名用的映射表与关键词，启动时构建一次，每次请求直接复用
+# 模式映射
+_MODE_MAP = {
+    "architect": "Architect",
+    "executor": "Executor",
+    "disruptor": "Disruptor"
+}
+# 按模式推断的默认类别（内容样本未命中关键词时使用）
+_CATEGORY_MAP = {
+    "architect": "LOGIC",
+    "executor": "ACTION",
+    "disruptor": "COGNI"
+}
+# 书名中过滤掉的常见无意义词
+_STOP_WORDS = frozenset({'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', '解构', '的', '与', '和'})
+# 内容样本关键词 -> 类别，按顺序匹配，每个类别一条预编译的正则（忽略大小写，无需先 lower）
+_CATEGORY_PATTERNS = {
+    "FIN": re.compile(r"投资|理财|基金|股票|finance|investment", re.I),
+    "COGNI": re.compile(r"认知|思维|心理|cognitive|psychology", re.I),
+    "BIZ": re.compile(r"商业|策略|管理|business|strategy", re.I),
+}
 
 def generate_filename(book_title, mode, book_content_sample=""):
     """
@@ -356,12 +560,7 @@ def generate_filename(book_title, mode, book_content_sample=""):
     示例：FIN_MutualFunds_Architect_20260123.md
     """
     # 模式映射
-    mode_map = {
-        "architect": "Architect",
-        "executor": "Executor", 
-        "disruptor": "Disruptor"
-    }
-    mode_name = mode_map.get(mode.lower(), "Architect")
+    mode_name = _MODE_MAP.get(mode.lower(), "Architect")
     
     # 生成日期
     date_str = datetime.datetime.now().strftime("%Y%m%d")
@@ -373,8 +572,7 @@ def generate_filename(book_title, mode, book_content_sample=""):
     # 提取关键词作为ShortName（取前2-3个有意义的词）
     words = book_title_clean.replace('_', ' ').replace('-', ' ').split()
     # 过滤掉常见无意义词
-    stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', '解构', '的', '与', '和'}
-    meaningful_words = [w for w in words if w.lower() not in stop_words and len(w) > 1]
+    meaningful_words = [w for w in words if w.lower() not in _STOP_WORDS and len(w) > 1]
     
     if meaningful_words:
         # 取前2-3个词，每个词取前几个字符
@@ -396,146 +594,212 @@ def generate_filename(book_title, mode, book_content_sample=""):
         short_name = "Book"
     
     # 类别识别（根据模式和内容样本，这里先用模式映射，后续可通过AI识别）
-    category_map = {
-        "architect": "LOGIC",
-        "executor": "ACTION",
-        "disruptor": "COGNI"
-    }
-    
-    # 如果内容样本包含特定关键词，可以更精确识别类别
-    if book_content_sample:
-        content_lower = book_content_sample.lower()[:500]  # 只检查前500字符
-        if any(word in content_lower for word in ['投资', '理财', '基金', '股票', 'finance', 'investment']):
-            category = "FIN"
-        elif any(word in content_lower for word in ['认知', '思维', '心理', 'cognitive', 'psychology']):
-            category = "COGNI"
-        elif any(word in content_lower for word in ['商业', '策略', '管理', 'business', 'strategy']):
-            category = "BIZ"
-        else:
-            category = category_map.get(mode.lower(), "GEN")
-    else:
-        category = category_map.get(mode.lower(), "GEN")
+    # 如果内容样本包含特定关键词，可以更精确识别类别（只检查前500字符）
+    content_head = book_content_sample[:500]
+    category = next(
+        (cat for cat, pattern in _CATEGORY_PATTERNS.items() if content_head and pattern.search(content_head)),
+        _CATEGORY_MAP.get(mode.lower(), "GEN")
+    )
     
     # 组合文件名
     filename = f"{category}_{short_name}_{mode_name}_{date_str}.md"
     return filename
 
-def split_into_chunks(text, chunk_size=10000):
-    """将文本按指定大小分割成多个块"""
+def _decode_token_slices(ids, size):
+    """按每片 size 个 token 切片解码
+
+    cl100k 的 token 是字节级的，切点可能落在一个汉字的 UTF-8 字节中间；用增量解码器把不完整的尾部字节留给下一片，
+    每片都在字符边界上结束，不会产生乱码（U+FFFD）；下一片因此最多多出一个字符的几个 token。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for i in range(0, len(ids), size):
+        piece = decoder.decode(TOKEN_ENCODING.decode_bytes(ids[i:i+size]), final=i + size >= len(ids))
+        if piece:
+            yield piece
+
+def split_into_chunks(text, chunk_size=CHUNK_TOKENS):
+    """将文本按 token 预算分割成多个块（chunk_size 单位为 token）"""
     chunks = []
-    current_chunk = ""
+    # 当前块在原文中的起止偏移与累计 token 数（段落分隔符按 1 个 token 计）
+    # 块内段落在原文中本就以 '\n\n' 相连，到边界时直接从原文切片，不再拼接中间缓冲
+    start = end = 0
+    buf_len = 0
+    offset = 0
     
-    # 按段落分割，尽量在段落边界处切割
+    # 按段落分割，尽量在段落边界处切割；所有段落批量编码一次
     paragraphs = text.split('\n\n')
-    
-    for para in paragraphs:
+    for para, ids in zip(paragraphs, TOKEN_ENCODING.encode_ordinary_batch(paragraphs)):
+        para_start = offset
+        offset += len(para) + 2
+        para_len = len(ids) + 1
         # 如果当前块加上新段落不超过限制，则添加
-        if len(current_chunk) + len(para) + 2 <= chunk_size:
-            current_chunk += para + '\n\n'
+        if buf_len + para_len <= chunk_size:
+            end = para_start + len(para)
+            buf_len += para_len
+            continue
+        # 如果当前块不为空，保存它
+        current_chunk = text[start:end].strip()
+        if current_chunk:
+            chunks.append(current_chunk)
+        # 如果单个段落就超过限制，按 token 直接切片
+        if len(ids) > chunk_size:
+            chunks.extend(_decode_token_slices(ids, chunk_size))
+            start = end = offset
+            buf_len = 0
         else:
-            # 如果当前块不为空，保存它
-            if current_chunk.strip():
-                chunks.append(current_chunk.strip())
-            # 如果单个段落就超过限制，强制切割
-            if len(para) > chunk_size:
-                # 按字符强制切割
-                for i in range(0, len(para), chunk_size):
-                    chunks.append(para[i:i+chunk_size])
-                current_chunk = ""
-            else:
-                current_chunk = para + '\n\n'
+            start, end = para_start, para_start + len(para)
+            buf_len = para_len
     
     # 添加最后一个块
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
+    current_chunk = text[start:end].strip()
+    if current_chunk:
+        chunks.append(current_chunk)
     
     return chunks
 
+def remove_temp_file(path):
+    """删除上传临时文件（小文件走内存，path 为 None）；在线程中调用，避免阻塞事件循环"""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+async def write_text_atomic(path, data):
+    """先写同目录下的临时文件再原子替换：并发请求在 path 上看到的要么不存在，要么是完整内容
+
+    data 可以是字符串，也可以是按顺序写入的字符串片段列表。
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+            if isinstance(data, str):
+                await f.write(data)
+            else:
+                await f.writelines(data)
+        await aiofiles.os.replace(tmp_path, path)
+    except BaseException:
+        await asyncio.to_thread(remove_temp_file, tmp_path)
+        raise
+
+def sse(payload):
+    """序列化一个 SSE 事件帧；orjson 直接输出 UTF-8 bytes，StreamingResponse 无需再编码"""
+    try:
+        data = orjson.dumps(payload)
+    except TypeError:
+        # 模型输出经 unicode_escape 处理后可能出现孤立代理字符（如字面量 \ud800），orjson 拒绝序列化；
+        # 退回标准库 json，以 \uXXXX 转义输出，保证整条 SSE 流不会因单帧中断
+        data = json.dumps(payload).encode("utf-8")
+    return b"data: " + data + b"\n\n"
+
 # 3. 核心业务接口 - 流式传输版本
 @app.post("/analyze")
 async def analyze_book(
+    request: Request,
     file: UploadFile = File(...),
-    prompt_type: str = Query("architect", description="提示词类型: architect, executor, disruptor")
+    prompt_type: str = Query("architect", description="提示词类型: architect, executor, disruptor"),
+    max_chars: int = Query(MAX_EXTRACT_CHARS, ge=0, description="最多提取的字数，0 表示读取全书")
 ):
-        # 保存临时文件
-        temp_path = f"temp_{file.filename}"
-        file_content = await file.read()
-        
+    # 验证提示词类型：FastAPI 在进入处理函数前已解析并暂存上传内容，这里提前校验，无效请求跳过哈希计算、文本提取和缓存查找
+    if prompt_type not in PROMPT_TEMPLATES:
+        raise HTTPException(status_code=400, detail=f"无效的提示词类型: {prompt_type}。可选值: architect, executor, disruptor")
+
+    ext = os.path.splitext(file.filename)[1].lower()
+    # 小文件直接留在内存中解析；超过 IN_MEMORY_UPLOAD_LIMIT 才落盘为临时文件
+    upload_buffer = bytearray()
+    temp_path = None
+
+    try:
+        # 按 1MB 分块读取并同步计算内容哈希（用于缓存检查），内存占用有上限
+        content_hash = new_content_hash()
+        temp_file = None
         try:
-            with open(temp_path, "wb") as f:
-                f.write(file_content)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                content_hash.update(chunk)
+                if temp_file is not None:
+                    await temp_file.write(chunk)
+                    continue
+                upload_buffer += chunk
+                if len(upload_buffer) > IN_MEMORY_UPLOAD_LIMIT:
+                    # 临时文件建在 OUTPUT_DIR 所在文件系统下，只保留扩展名（避免用户文件名带来的路径穿越）
+                    fd, temp_path = tempfile.mkstemp(suffix=ext, dir=OUTPUT_DIR)
+                    os.close(fd)
+                    temp_file = await aiofiles.open(temp_path, "wb")
+                    await temp_file.write(upload_buffer)
+                    upload_buffer = None
+        finally:
+            if temp_file is not None:
+                await temp_file.close()
+        file_hash = content_hash.hexdigest()
+        # 提取字数上限不同，结果也不同，需要计入缓存键
+        content_key = f"{file_hash}_{max_chars}"
+        cache_filename = f"cache_{content_key}_{prompt_type}.md"
+        cache_path = os.path.join(OUTPUT_DIR, cache_filename)
+
+        # 缓存机制：哈希一算出就检查；如果同一个文件已经被解构过，立即丢弃上传内容并直接返回
+        if os.path.exists(cache_path):
+            print(f"[LOG] 发现缓存文件，直接返回: {cache_filename}")
+            await asyncio.to_thread(remove_temp_file, temp_path)
+            upload_buffer = None
+            # 读取缓存内容
+            async with aiofiles.open(cache_path, "r", encoding="utf-8") as f:
+                cached_content = await f.read()
             
-            # 计算文件MD5，用于缓存检查
-            file_md5 = hashlib.md5(file_content).hexdigest()
-            cache_filename = f"cache_{file_md5}_{prompt_type}.md"
-            cache_path = os.path.join(OUTPUT_DIR, cache_filename)
+            # 生成新的文件名（格式：Category_BookName_Mode_Timestamp.md）
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            book_name = os.path.splitext(file.filename)[0]
+            book_name = "".join(c for c in book_name if c.isalnum() or c in (' ', '-', '_')).strip()
+            book_name = book_name.replace(' ', '_')
+            category = _CATEGORY_MAP.get(prompt_type, "GEN")
+            mode_name = prompt_type.capitalize()
+            safe_filename = f"{category}_{book_name}_{mode_name}_{timestamp}.md"
+            full_save_path = os.path.join(OUTPUT_DIR, safe_filename)
             
-            # 缓存机制：如果同一个文件已经被解构过，直接返回
-            if os.path.exists(cache_path):
-                print(f"[LOG] 发现缓存文件，直接返回: {cache_filename}")
-                # 读取缓存内容
-                with open(cache_path, "r", encoding="utf-8") as f:
-                    cached_content = f.read()
-                
-                # 生成新的文件名（格式：Category_BookName_Mode_Timestamp.md）
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                book_name = os.path.splitext(file.filename)[0]
-                book_name = "".join(c for c in book_name if c.isalnum() or c in (' ', '-', '_')).strip()
-                book_name = book_name.replace(' ', '_')
-                category_map = {
-                    "architect": "LOGIC",
-                    "executor": "ACTION",
-                    "disruptor": "COGNI"
+            # 复制缓存文件到新文件名
+            await asyncio.to_thread(shutil.copy2, cache_path, full_save_path)
+
+            # 流式返回缓存内容
+            async def generate_cached_stream():
+                yield sse({'type': 'filename', 'filename': safe_filename})
+                yield sse({'type': 'status', 'msg': '使用缓存结果，快速返回...'})
+                yield sse({'type': 'progress', 'val': 50})
+                # 缓存内容一次性发送（使用新格式 val），不再切成 100 字一帧模拟流式
+                yield sse({'type': 'content', 'val': cached_content})
+                yield sse({'type': 'done', 'filename': safe_filename})
+
+            return StreamingResponse(
+                generate_cached_stream(),
+                media_type="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                    "X-Accel-Buffering": "no"
                 }
-                category = category_map.get(prompt_type, "GEN")
-                mode_name = prompt_type.capitalize()
-                safe_filename = f"{category}_{book_name}_{mode_name}_{timestamp}.md"
-                full_save_path = os.path.join(OUTPUT_DIR, safe_filename)
-                
-                # 复制缓存文件到新文件名
-                import shutil
-                shutil.copy2(cache_path, full_save_path)
-                
-                # 流式返回缓存内容
-                async def generate_cached_stream():
-                    yield f"data: {json.dumps({'type': 'filename', 'filename': safe_filename}, ensure_ascii=False)}\n\n"
-                    yield f"data: {json.dumps({'type': 'status', 'msg': '使用缓存结果，快速返回...'}, ensure_ascii=False)}\n\n"
-                    yield f"data: {json.dumps({'type': 'progress', 'val': 50}, ensure_ascii=False)}\n\n"
-                    # 模拟流式输出缓存内容（使用新格式 val）
-                    chunk_size = 100
-                    for i in range(0, len(cached_content), chunk_size):
-                        chunk = cached_content[i:i+chunk_size]
-                        yield f"data: {json.dumps({'type': 'content', 'val': chunk}, ensure_ascii=False)}\n\n"
-                    yield f"data: {json.dumps({'type': 'done', 'filename': safe_filename}, ensure_ascii=False)}\n\n"
-                
-                return StreamingResponse(
-                    generate_cached_stream(),
-                    media_type="text/event-stream",
-                    headers={
-                        "Cache-Control": "no-cache",
-                        "Connection": "keep-alive",
-                        "X-Accel-Buffering": "no"
-                    }
-                )
-            
-        # 验证并获取提示词
-        if prompt_type not in PROMPT_TEMPLATES:
-            raise HTTPException(status_code=400, detail=f"无效的提示词类型: {prompt_type}。可选值: architect, executor, disruptor")
-        
-        system_prompt = PROMPT_TEMPLATES[prompt_type]
-        
-        # 生成初步脱水提示词（用于分段解构）
-        preliminary_prompt = """你是一位知识提取专家。请对提供的文本片段进行"初步脱水"：
-1. 提取核心观点和关键信息
-2. 保留重要的数据、公式、案例
-3. 去除冗余描述和修饰性语言
-4. 保持逻辑结构清晰
-5. 输出格式为简洁的 Markdown
+            )
 
-请开始脱水："""
+        system_message = SYSTEM_MESSAGES[prompt_type]
+        # 复用 lifespan 中创建的客户端（共享连接池）
+        client = request.app.state.openai
 
-        # 提取文字（支持全书读取）- 先提取用于文件名生成
-        book_content = extract_text_from_any(temp_path)
+        # 提取文字（支持全书读取）- 先提取用于文件名生成；同一文件只提取一次
+        text_cache_path = os.path.join(CACHE_DIR, f"{content_key}.txt")
+        if os.path.exists(text_cache_path):
+            print(f"[LOG] 命中文本缓存: {text_cache_path}")
+            async with aiofiles.open(text_cache_path, "r", encoding="utf-8") as f:
+                book_content = await f.read()
+        else:
+            book_content = await extract_text_async(
+                request.app,
+                temp_path or upload_buffer,
+                ext,
+                max_chars
+            )
+            if book_content.strip():
+                # 三种模式可能同时解构同一本书，原子写入，避免其他请求读到半截文本；写缓存失败（磁盘满、无权限等）不影响本次解构
+                try:
+                    await write_text_atomic(text_cache_path, book_content)
+                except Exception as e:
+                    print(f"[LOG] 文本缓存写入失败: {e}")
+        # 原文件只用于提取文字，此后即可释放
+        await asyncio.to_thread(remove_temp_file, temp_path)
+        upload_buffer = None
         if not book_content.strip():
             raise HTTPException(status_code=400, detail="无法提取内容，请确保文件未加密")
         
@@ -549,80 +813,157 @@ async def analyze_book(
             accumulated_text = ""
             try:
                 # 先发送文件名信息
-                yield f"data: {json.dumps({'type': 'filename', 'filename': safe_filename}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'filename', 'filename': safe_filename})
                 
                 # 发送进度信息
-                yield f"data: {json.dumps({'type': 'status', 'msg': '开始全书解析...'}, ensure_ascii=False)}\n\n"
-                yield f"data: {json.dumps({'type': 'progress', 'val': 5}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'status', 'msg': '开始全书解析...'})
+                yield sse({'type': 'progress', 'val': 5})
+                # 提取结果恰好达到字数上限，说明后面的内容被截掉了，需要明确告知，避免把部分解构当成全书解构
+                if max_chars and len(book_content) >= max_chars:
+                    yield sse({'type': 'status', 'msg': f'全书内容超过 {max_chars} 字，已截断，仅解构前 {max_chars} 字（设置 max_chars=0 可读取全书）'})
                 
-                # 分段切割：每10,000字为一个Chunk（Map-Reduce 模式）
-                yield f"data: {json.dumps({'type': 'status', 'msg': '正在分段读取全书...'}, ensure_ascii=False)}\n\n"
-                chunks = split_into_chunks(book_content, chunk_size=10000)
-                total_chunks = len(chunks)
+                # 全文本身就能放进一次上下文时，跳过分段脱水，直接用原文做全局汇总
+                book_tokens = count_tokens(book_content)
+                dehydrated_cache_path = os.path.join(CACHE_DIR, f"{content_key}.dehydrated.txt")
+                if book_tokens + PROMPT_TOKENS[prompt_type] <= ONE_SHOT_TOKENS:
+                    yield sse({'type': 'status', 'msg': f'全书约 {book_tokens} tokens，可一次性解构，跳过分段脱水...'})
+                    summary_request = f"请基于以下全书内容，按照指定模式进行深度解构和全局汇总：\n\n{book_content}"
+                # 脱水稿只取决于原文，命中缓存时跳过整个分段解构阶段
+                elif os.path.exists(dehydrated_cache_path):
+                    yield sse({'type': 'status', 'msg': '命中脱水稿缓存，跳过分段解构...'})
+                    async with aiofiles.open(dehydrated_cache_path, "r", encoding="utf-8") as f:
+                        combined_dehydrated = await f.read()
+                    summary_request = f"请基于以下已脱水的全书内容，按照指定模式进行深度解构和全局汇总：\n\n{combined_dehydrated}"
+                else:
+                    yield sse({'type': 'status', 'msg': f'全书约 {book_tokens} tokens，超出单次上下文预算，采用分段脱水...'})
+                    # 分段切割：每个请求（提示词 + 片段）控制在 CHUNK_TOKENS 个 token 内（Map-Reduce 模式）
+                    yield sse({'type': 'status', 'msg': '正在分段读取全书...'})
+                    chunks = split_into_chunks(book_content, chunk_size=CHUNK_TOKENS - PRELIMINARY_PROMPT_TOKENS)
+                    total_chunks = len(chunks)
                 
-                yield f"data: {json.dumps({'type': 'status', 'msg': f'全书已分割为 {total_chunks} 个片段，开始并发解构（Map-Reduce模式）...'}, ensure_ascii=False)}\n\n"
-                yield f"data: {json.dumps({'type': 'progress', 'val': 10}, ensure_ascii=False)}\n\n"
+                    yield sse({'type': 'status', 'msg': f'全书已分割为 {total_chunks} 个片段，开始并发解构（Map-Reduce模式）...'})
+                    yield sse({'type': 'progress', 'val': 10})
                 
-                # 并发解构：使用 asyncio.gather 并行调用 DeepSeek API
-                async def process_chunk(chunk, index):
-                    """处理单个chunk的异步函数"""
-                    try:
-                        print(f"[LOG] 开始处理片段 {index + 1}/{total_chunks}")
-                        # 调用 DeepSeek API 进行初步脱水（非流式，因为需要完整结果）
-                        response = await client.chat.completions.create(
-                            model="deepseek-chat",
-                            messages=[
-                                {"role": "system", "content": preliminary_prompt},
-                                {"role": "user", "content": f"请对以下文本片段进行初步脱水：\n\n{chunk}"}
-                            ],
-                            stream=False
-                        )
-                        dehydrated_text = response.choices[0].message.content
-                        print(f"[LOG] 片段 {index + 1}/{total_chunks} 处理完成")
-                        return (index, dehydrated_text)
-                    except Exception as e:
-                        # 如果某个片段处理失败，使用原文本
-                        print(f"[LOG] 片段 {index + 1}/{total_chunks} 处理失败: {e}")
-                        return (index, chunk)
+                    # 并发解构：并行调用 DeepSeek API，用信号量限制同时在途的请求数
+                    semaphore = asyncio.Semaphore(DEHYDRATE_CONCURRENCY)
+                    dehydrate_client = client.with_options(max_retries=DEHYDRATE_MAX_RETRIES)
+
+                    async def process_chunk(chunk, index, chunk_key):
+                        """处理单个chunk的异步函数（chunk_key 为片段内容哈希，同时用作去重键和缓存文件名）"""
+                        # 片段脱水结果只取决于片段原文，命中缓存时不调用 API
+                        chunk_cache_path = os.path.join(CHUNK_CACHE_DIR, f"{chunk_key}.md")
+                        # 缓存读取失败（文件恰好被删除、内容损坏等）一律视为未命中，回退到调用 API
+                        try:
+                            async with aiofiles.open(chunk_cache_path, "r", encoding="utf-8") as f:
+                                dehydrated_text = await f.read()
+                            print(f"[LOG] 片段 {index + 1}/{total_chunks} 命中缓存")
+                            return (chunk_key, dehydrated_text, True)
+                        except FileNotFoundError:
+                            pass
+                        except Exception as e:
+                            print(f"[LOG] 片段 {index + 1}/{total_chunks} 缓存读取失败，重新解构: {e}")
+                        try:
+                            async with semaphore:
+                                print(f"[LOG] 开始处理片段 {index + 1}/{total_chunks}")
+                                # 调用 DeepSeek API 进行初步脱水（非流式，因为需要完整结果）
+                                response = await dehydrate_client.chat.completions.create(
+                                    model="deepseek-chat",
+                                    messages=[
+                                        PRELIMINARY_MESSAGE,
+                                        {"role": "user", "content": f"请对以下文本片段进行初步脱水：\n\n{chunk}"}
+                                    ],
+                                    stream=False
+                                )
+                            dehydrated_text = response.choices[0].message.content
+                            print(f"[LOG] 片段 {index + 1}/{total_chunks} 处理完成")
+                        except Exception as e:
+                            # 如果某个片段处理失败，使用原文本
+                            print(f"[LOG] 片段 {index + 1}/{total_chunks} 处理失败: {e}")
+                            return (chunk_key, chunk, False)
+                        # 原子写入缓存，并发请求不会读到写了一半的结果；写缓存失败不影响本次脱水结果
+                        try:
+                            await write_text_atomic(chunk_cache_path, dehydrated_text)
+                        except Exception as e:
+                            print(f"[LOG] 片段 {index + 1}/{total_chunks} 缓存写入失败: {e}")
+                        return (chunk_key, dehydrated_text, True)
                 
-                # 创建所有任务
-                tasks = [process_chunk(chunk, i) for i, chunk in enumerate(chunks)]
+                    # 按内容哈希去重：重复出现的片段（版权页、页眉页脚、参考文献等）只请求一次，结果回填到所有原位置
+                    positions = {}
+                    for i, chunk in enumerate(chunks):
+                        positions.setdefault(new_content_hash(chunk.encode('utf-8')).hexdigest(), []).append(i)
+                    if len(positions) < total_chunks:
+                        print(f"[LOG] {total_chunks} 个片段中有 {total_chunks - len(positions)} 个重复，实际解构 {len(positions)} 个")
+
+                    # 创建所有任务：每个不同的片段一个任务
+                    tasks = [process_chunk(chunks[indices[0]], indices[0], key) for key, indices in positions.items()]
                 
-                # 并发执行，但每完成一个就发送进度更新
-                dehydrated_chunks = [None] * total_chunks
-                completed_count = 0
+                    # 并发执行，但每完成一个就发送进度更新
+                    dehydrated_chunks = [None] * total_chunks
+                    completed_count = 0
+                    failed_count = 0
                 
-                # 使用 asyncio.as_completed 来实时获取完成的任务
-                for coro in asyncio.as_completed(tasks):
-                    index, result = await coro
-                    dehydrated_chunks[index] = result
-                    completed_count += 1
-                    # 进度感知：每完成一个 Chunk 就 yield 一个进度百分比
-                    progress_percent = int((completed_count / total_chunks) * 45) + 35  # 35%-80% 范围
-                    yield f"data: {json.dumps({'type': 'status', 'msg': f'正在解构第{completed_count}章节（共{total_chunks}章节）...'}, ensure_ascii=False)}\n\n"
-                    yield f"data: {json.dumps({'type': 'progress', 'val': progress_percent}, ensure_ascii=False)}\n\n"
+                    # 使用 asyncio.as_completed 来实时获取完成的任务
+                    for coro in asyncio.as_completed(tasks):
+                        chunk_key, result, ok = await coro
+                        indices = positions[chunk_key]
+                        for index in indices:
+                            dehydrated_chunks[index] = result
+                        completed_count += len(indices)
+                        if not ok:
+                            failed_count += len(indices)
+                        # 进度感知：每完成一个 Chunk 就 yield 一个进度百分比
+                        progress_percent = int((completed_count / total_chunks) * 45) + 35  # 35%-80% 范围
+                        yield sse({'type': 'status', 'msg': f'正在解构第{completed_count}章节（共{total_chunks}章节）...'})
+                        yield sse({'type': 'progress', 'val': progress_percent})
                 
-                # 合并所有脱水稿
-                combined_dehydrated = "\n\n---\n\n".join(dehydrated_chunks)
+                    # 合并所有脱水稿：片段之间插入分隔线，连同提示语一次 join 成汇总请求，不再先拼出整篇脱水稿再复制一遍
+                    parts = ["请基于以下已脱水的全书内容，按照指定模式进行深度解构和全局汇总：\n\n"]
+                    for i, dehydrated in enumerate(dehydrated_chunks):
+                        if i:
+                            parts.append("\n\n---\n\n")
+                        parts.append(dehydrated)
+
+                    # 仅在所有片段都成功脱水时写缓存，避免把失败回退的原文固化下来；直接逐段写入，不拼接，原子替换防止并发请求读到半截
+                    # 写缓存失败不影响本次汇总：脱水结果已经到手，不能因为缓存丢掉整份报告
+                    if failed_count == 0:
+                        try:
+                            await write_text_atomic(dehydrated_cache_path, parts[1:])
+                        except Exception as e:
+                            print(f"[LOG] 脱水稿缓存写入失败: {e}")
+                    summary_request = "".join(parts)
+                    # 汇总请求已包含全部内容，释放片段列表，流式汇总期间不再保留第二份脱水稿
+                    del parts, dehydrated_chunks
+
+                    yield sse({'type': 'status', 'msg': '所有片段处理完成，开始全局汇总...'})
                 
-                yield f"data: {json.dumps({'type': 'status', 'msg': '所有片段处理完成，开始全局汇总...'}, ensure_ascii=False)}\n\n"
-                yield f"data: {json.dumps({'type': 'progress', 'val': 80}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'progress', 'val': 80})
                 
                 # 全局汇总：按照"解构模式"进行最终的全书汇总
                 # 开启流式传输：使用 stream=True，每生成一个片段就立即 yield 给前端
-                yield f"data: {json.dumps({'type': 'status', 'msg': '开始全局汇总，生成最终解构报告...'}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'status', 'msg': '开始全局汇总，生成最终解构报告...'})
                 
                 response = await client.chat.completions.create(
                     model="deepseek-chat",
                     messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": f"请基于以下已脱水的全书内容，按照指定模式进行深度解构和全局汇总：\n\n{combined_dehydrated}"}
+                        system_message,
+                        {"role": "user", "content": summary_request}
                     ],
                     stream=True  # 关键：必须使用 stream=True
                 )
                 
-                # 流式接收最终汇总结果：每生成一个片段就立即 yield 给前端
+                def content_frame(content):
+                    # 使用 unicode_escape 处理特殊字符
+                    try:
+                        content_escaped = content.encode("utf-8").decode("unicode_escape")
+                    except:
+                        content_escaped = content
+                    return sse({'type': 'content', 'val': content_escaped})
+
+                # 流式接收最终汇总结果：增量先攒入 pending，攒够字数或时间窗口到期就合并成一帧 yield 给前端
                 chunk_count = 0
+                pending = []
+                pending_len = 0
+                last_flush = time.monotonic()
                 async for chunk in response:
                     if chunk.choices and len(chunk.choices) > 0:
                         delta = chunk.choices[0].delta
@@ -630,57 +971,65 @@ async def analyze_book(
                             content = delta.content
                             accumulated_text += content
                             chunk_count += 1
-                            # 关键：每生成一个片段就立即 yield 给前端
-                            # 使用 unicode_escape 处理特殊字符
-                            try:
-                                content_escaped = content.encode("utf-8").decode("unicode_escape")
-                            except:
-                                content_escaped = content
-                            yield f"data: {json.dumps({'type': 'content', 'val': content_escaped}, ensure_ascii=False)}\n\n"
+                            pending.append(content)
+                            pending_len += len(content)
+                            # 关键：窗口到期就立即 yield，前端观感与逐片段推送一致，但帧数大幅减少
+                            now = time.monotonic()
+                            if pending_len >= SSE_FLUSH_CHARS or now - last_flush >= SSE_FLUSH_INTERVAL:
+                                yield content_frame("".join(pending))
+                                pending.clear()
+                                pending_len = 0
+                                last_flush = now
                             
                             # 每100个chunk更新一次进度（85%-95%）
                             if chunk_count % 100 == 0:
                                 progress_val = min(85 + int((chunk_count / 1000) * 10), 95)
-                                yield f"data: {json.dumps({'type': 'status', 'msg': f'正在生成内容...（已生成 {chunk_count} 个片段）'}, ensure_ascii=False)}\n\n"
-                                yield f"data: {json.dumps({'type': 'progress', 'val': progress_val}, ensure_ascii=False)}\n\n"
+                                yield sse({'type': 'status', 'msg': f'正在生成内容...（已生成 {chunk_count} 个片段）'})
+                                yield sse({'type': 'progress', 'val': progress_val})
                 
-                # 流式传输完成后，保存完整文件
-                with open(full_save_path, "w", encoding="utf-8") as f:
-                    f.write(accumulated_text)
+                # 推送窗口内剩余的内容
+                if pending:
+                    yield content_frame("".join(pending))
+
+                # 流式传输完成后，保存完整文件（aiofiles 在线程中写盘，不阻塞其他 SSE 连接）
+                async with aiofiles.open(full_save_path, "w", encoding="utf-8") as f:
+                    await f.write(accumulated_text)
                 
-                # 同时保存到缓存
-                with open(cache_path, "w", encoding="utf-8") as f:
-                    f.write(accumulated_text)
-                print(f"[LOG] 已保存缓存文件: {cache_filename}")
+                # 同时保存到缓存：其他请求以文件是否存在判断命中，必须原子写入，不能让它读到写了一半的报告
+                # 报告本身已保存，写缓存失败只记录日志，照常发送完成信号
+                try:
+                    await write_text_atomic(cache_path, accumulated_text)
+                    print(f"[LOG] 已保存缓存文件: {cache_filename}")
+                except Exception as e:
+                    print(f"[LOG] 缓存文件写入失败: {e}")
                 
                 # 发送完成信号
-                yield f"data: {json.dumps({'type': 'done', 'filename': safe_filename}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'done', 'filename': safe_filename})
                 
-            except ConnectError as e:
-                # 连接错误：可能是网络问题或代理问题
-                error_msg = "无法连接到 DeepSeek API。请检查：\n1. 网络连接是否正常\n2. VPN 状态是否正确\n3. 防火墙设置是否阻止了连接"
-                print(f"连接错误: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
-            except (TimeoutException, ReadTimeout, ConnectTimeout) as e:
+            # AsyncOpenAI 会把 httpx 的网络异常包装成 APITimeoutError / APIConnectionError 再抛出；
+            # APITimeoutError 是 APIConnectionError 的子类，超时分支必须放在前面
+            except (TimeoutException, ReadTimeout, ConnectTimeout, APITimeoutError) as e:
                 # 超时错误：可能是代理超时或网络慢
                 timeout_type = type(e).__name__
                 error_msg = f"API 请求超时 ({timeout_type})。请检查：\n1. 网络连接是否稳定\n2. VPN 是否正常工作\n3. 代理设置是否正确（建议直连 api.deepseek.com）"
                 print(f"超时错误: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'error', 'error': error_msg})
+            except (ConnectError, APIConnectionError) as e:
+                # 连接错误：可能是网络问题或代理问题
+                error_msg = "无法连接到 DeepSeek API。请检查：\n1. 网络连接是否正常\n2. VPN 状态是否正确\n3. 防火墙设置是否阻止了连接"
+                print(f"连接错误: {e}")
+                yield sse({'type': 'error', 'error': error_msg})
             except RequestError as e:
                 # 请求错误：可能是代理或其他网络问题
                 error_msg = f"网络请求失败。请检查网络连接或 VPN 状态。错误详情: {str(e)}"
                 print(f"请求错误: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
+                yield sse({'type': 'error', 'error': error_msg})
             except Exception as e:
                 # 其他异常
                 error_type = type(e).__name__
                 error_msg = f"API 调用失败 ({error_type}): {str(e)}"
                 print(f"API 调用异常: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
-            finally:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+                yield sse({'type': 'error', 'error': error_msg})
         
         return StreamingResponse(
             generate_stream(),
@@ -692,54 +1041,62 @@ async def analyze_book(
             }
         )
     
+    except HTTPException:
+        await asyncio.to_thread(remove_temp_file, temp_path)
+        raise
     except Exception as e:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        await asyncio.to_thread(remove_temp_file, temp_path)
         raise HTTPException(status_code=500, detail=str(e))
+
+# 4. 下载接口
 @app.get("/download/{filename}")
 async def download_file(filename: str):
     # 解码前端传来的 URL 编码
     real_filename = urllib.parse.unquote(filename)
     
-    # 这里的路径一定要和你保存时的 OUTPUT_DIR 绝对一致
-    output_dir = os.getenv("OUTPUT_DIRECTORY", "/app/output")
-    file_path = os.path.join(output_dir, real_filename)
+    # 报告都直接保存在 OUTPUT_DIR 下：文件名不允许带路径分隔符或 ..，防止路径穿越和读取缓存目录；
+    # 含 NUL 字符的路径会让 os.stat 抛出 ValueError，同样直接拒绝
+    if "/" in real_filename or "\\" in real_filename or ".." in real_filename or "\x00" in real_filename:
+        raise HTTPException(status_code=400, detail="非法文件名")
+    file_path = os.path.join(OUTPUT_DIR_ABS, real_filename)
     
-    print(f"DEBUG: 正在尝试下载文件: {file_path}") # 增加调试日志
-
-    if os.path.exists(file_path):
+    try:
+        stat_result = os.stat(file_path)
+    except (OSError, ValueError):
+        stat_result = None
+    if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+        # FileResponse 会按 RFC 5987 编码中文文件名，并强制浏览器作为附件下载
+        # 传入已有的 stat 结果，省去一次 stat 调用，Content-Length 直接由它给出（gzip 压缩时由中间件改写）
         return FileResponse(
-            path=file_path, 
+            path=file_path,
             filename=real_filename,
-            # 强制浏览器作为附件下载
+            media_type="text/markdown",
+            stat_result=stat_result,
             content_disposition_type="attachment"
         )
-    else:
-        # 如果找不到，返回 404，这样前端控制台能看到具体报错
-        raise HTTPException(status_code=404, detail=f"File not found at {file_path}")
-# 4. 下载接口
-@app.get("/download/{filename}")
-async def download_file(filename: str):
-    file_path = os.path.join(OUTPUT_DIR, filename)
-    if os.path.exists(file_path):
-        encoded_filename = urllib.parse.quote(filename)
-        return FileResponse(
-            path=file_path, 
-            filename=filename,
-            headers={"Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}"}
-        )
     raise HTTPException(status_code=404, detail="文件不存在")
 
 # 5. 配置查询接口
 @app.get("/config")
 def get_config():
-    return {"current_output_dir": os.path.abspath(OUTPUT_DIR)}
+    return {"current_output_dir": OUTPUT_DIR_ABS}
+
+# 6. 前端入口（启动时读入内存，之后每次请求不再访问磁盘）
+INDEX_PATH = os.path.join("..", "frontend", "index.html")
+INDEX_HTML = None
+# 按内容生成 ETag：浏览器刷新时带上 If-None-Match，内容未变直接返回 304，不再重复传输整页
+INDEX_ETAG = None
+if os.path.exists(INDEX_PATH):
+    with open(INDEX_PATH, "rb") as f:
+        INDEX_HTML = f.read()
+    INDEX_ETAG = f'"{new_content_hash(INDEX_HTML).hexdigest()}"'
 
-# 6. 前端入口
 @app.get("/", response_class=HTMLResponse)
-async def read_index():
-    index_path = os.path.join("..", "frontend", "index.html")
-    if os.path.exists(index_path):
-        with open(index_path, "r", encoding="utf-8") as f:
-            return f.read()
-    return "前端文件 index.html 不存在，请检查路径"
\ No newline at end of file
+async def read_index(request: Request):
+    if INDEX_HTML is None:
+        return "前端文件 index.html 不存在，请检查路径"
+    # no-cache：每次都向服务端确认，前端更新后重启即可生效
+    headers = {"ETag": INDEX_ETAG, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=INDEX_HTML, headers=headers)